@@ -15,54 +15,29 @@ You should have received a copy of the GNU General Public License along with Ken
 """
 
 import asyncio
+import logging
 import os
 
 import crescent
 import hikari
 
-from bot.constants import DISCORD_TOKEN, ERROR_LOG_PATH
+from bot.constants import DISCORD_TOKEN, LOGGING_CONFIG
 
 if os.name != "nt":
     import uvloop
 
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-audit_bot = hikari.GatewayBot(
-    DISCORD_TOKEN,
-    logs={
-        "version": 1,
-        "formatters": {"standard": {"format": "%(asctime)s [%(levelname)s] %(name)s %(message)s"}},
-        "handlers": {
-            "default": {
-                "class": "logging.FileHandler",
-                "level": "DEBUG",
-                "formatter": "standard",
-                "filename": ERROR_LOG_PATH,
-                "encoding": "utf-8",
-            },
-            "output": {
-                "class": "logging.StreamHandler",
-                "level": "DEBUG",
-                "stream": "ext://sys.stdout",
-                "formatter": "standard",
-            },
-        },
-        "loggers": {
-            "": {  # root logger
-                "handlers": ["default", "output"],
-                "propagate": False,
-                "level": "DEBUG",
-            }
-        },
-    },
-)
-
-client = crescent.Client(audit_bot)
-client.plugins.load_folder("bot.plugins")
-
-
 def main():
+    # The bot is only built here so that importing the package, as the ingestion worker does, has no side effects
+    audit_bot = hikari.GatewayBot(DISCORD_TOKEN, logs=LOGGING_CONFIG)
+    log_listener = logging.getHandlerByName("queue").listener
+    log_listener.start()
+
+    client = crescent.Client(audit_bot)
+    client.plugins.load_folder("bot.plugins")
     try:
         audit_bot.run()
     finally:
+        log_listener.stop()
         print("Bot Stopped Successfully!")
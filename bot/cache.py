@@ -0,0 +1,99 @@
+"""Defines caching structures for messages fetched by the bot.
+Copyright © 2025 Dnd World
+
+This file is part of Kensa.
+Kensa is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+later version.
+
+Kensa is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with Kensa. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import hikari
+
+
+@dataclass(frozen=True, slots=True)
+class StoredMessage:
+    """Class to hold the parts of a Discord message needed to audit it"""
+
+    message_id: int
+    channel_id: int
+    timestamp: float
+    content: str | None
+    embed: dict | None
+
+    @classmethod
+    def from_message(cls, message: hikari.Message) -> "StoredMessage":
+        """Create a stored message from a message fetched from Discord.
+
+        Arguments:
+          message -- The message fetched from Discord.
+
+        Returns:
+          The stored representation of the message.
+        """
+        embed = None
+        if message.embeds:
+            raw_embed = message.embeds[0]
+            embed = {
+                "title": raw_embed.title,
+                "description": raw_embed.description,
+                "fields": [[field.name, field.value] for field in raw_embed.fields],
+                "footer": None if raw_embed.footer is None else raw_embed.footer.text,
+            }
+        return cls(message.id, message.channel_id, message.timestamp.timestamp(), message.content, embed)
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "StoredMessage":
+        """Create a stored message from a row of the message_payloads table.
+
+        Arguments:
+          row -- The row in the order (message_id, channel_id, message_timestamp, content, embed).
+
+        Returns:
+          The stored representation of the message.
+        """
+        message_id, channel_id, timestamp, content, embed = row
+        return cls(message_id, channel_id, timestamp, content, None if embed is None else json.loads(embed))
+
+    def to_row(self) -> dict:
+        """Convert the stored message to the named parameters of the message_payloads table."""
+        return {
+            "message_id": self.message_id,
+            "channel_id": self.channel_id,
+            "timestamp": self.timestamp,
+            "content": self.content,
+            "embed": None if self.embed is None else json.dumps(self.embed),
+        }
+
+
+class MessageCache:
+    """Bounded least-recently-used cache of messages fetched from Discord"""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._messages: OrderedDict[int, StoredMessage] = OrderedDict()
+
+    def get(self, message_id: int) -> StoredMessage | None:
+        message = self._messages.get(message_id)
+        if message is not None:
+            self._messages.move_to_end(message_id)
+        return message
+
+    def put(self, message: StoredMessage) -> None:
+        self._messages[message.message_id] = message
+        self._messages.move_to_end(message.message_id)
+        while len(self._messages) > self.max_size:
+            self._messages.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._messages)
@@ -15,13 +15,14 @@ You should have received a copy of the GNU General Public License along with Ken
 """
 
 import datetime
+import json
 import os
 
 import crescent
 import hikari
 from dotenv import find_dotenv, load_dotenv
 
-from bot.database import Database
+from bot.database import Database, DatabaseRouter
 
 
 load_dotenv(find_dotenv(usecwd=True))
@@ -39,15 +40,20 @@ if AVRAE_ID is None:
 GUILD_ID = os.environ.get("GUILD_ID")
 if GUILD_ID is None:
     raise ValueError("GUILD_ID environment variable is not set.")
+GUILD_ID = int(GUILD_ID)
 
 DEV_IDS = os.environ.get("DEV_IDS")
 if DEV_IDS is None:
     raise ValueError("DEV_IDS environment variable is not set.")
 DEV_IDS = DEV_IDS.split(",")
 
-MAIN_DATABASE_PATH = os.path.join(os.getcwd(), "resources", "database.sqlite")
-GUILD_DATABASE_PATH = os.path.join(os.getcwd(), "resources", "guild.sqlite")
-EARLIEST_AUDIT_PATH = os.path.join(os.getcwd(), "resources", "earliest_audit.txt")
+GUILD_CONFIG_PATH = os.path.join(os.getcwd(), "resources", "guilds.json")
+DATABASE_IDLE_TIMEOUT = float(os.environ.get("DATABASE_IDLE_TIMEOUT", "900"))
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", "86400"))
+MAINTENANCE_IDLE_TIME = 300
+MAINTENANCE_BACKUP_COUNT = 3
+# Writers wait this long for a lock, so a full VACUUM by the other process delays rather than fails them
+DATABASE_BUSY_TIMEOUT = float(os.environ.get("DATABASE_BUSY_TIMEOUT", "600"))
 GUILD_DTD_CHOICES = [
     ("alchem", "alchem"),
     ("arcana", "arcana"),
@@ -104,7 +110,88 @@ CHANNEL_CHOICES = [
 ]
 
 ERROR_LOG_PATH = os.path.normpath(os.path.join(os.getcwd(), "logs", f"{datetime.datetime.now()}.log"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+HIKARI_LOG_LEVEL = os.environ.get("HIKARI_LOG_LEVEL", "INFO").upper()
+# Matches the number of messages hikari fetches per REST request
+INGESTION_LOG_PAGE_SIZE = 100
+LOGGING_CONFIG = {
+    "version": 1,
+    "formatters": {"standard": {"format": "%(asctime)s [%(levelname)s] %(name)s %(message)s"}},
+    "handlers": {
+        "default": {
+            "class": "logging.FileHandler",
+            "level": "DEBUG",
+            "formatter": "standard",
+            "filename": ERROR_LOG_PATH,
+            "encoding": "utf-8",
+        },
+        "output": {
+            "class": "logging.StreamHandler",
+            "level": "DEBUG",
+            "stream": "ext://sys.stdout",
+            "formatter": "standard",
+        },
+        # Records are handed to a background thread so disk and terminal writes never block the event loop
+        "queue": {
+            "class": "logging.handlers.QueueHandler",
+            "handlers": ["default", "output"],
+            "respect_handler_level": True,
+        },
+    },
+    "loggers": {
+        "": {  # root logger
+            "handlers": ["queue"],
+            "propagate": False,
+            "level": LOG_LEVEL,
+        },
+        "hikari": {
+            "level": HIKARI_LOG_LEVEL,
+        },
+    },
+}
+
+# "inline" ingests messages inside the bot process, "worker" hands ingestion to the bot.worker process
+INGESTION_MODE = os.environ.get("INGESTION_MODE", "inline")
+INGESTION_POLL_INTERVAL = float(os.environ.get("INGESTION_POLL_INTERVAL", "60"))
+INGESTION_JOB_POLL_INTERVAL = 1
+INGESTION_JOB_TIMEOUT = 3600
 
 CHANNEL_LIST = []
 
-database = Database()
+GET_MESSAGE_LIMIT = 25
+MESSAGE_CACHE_SIZE = 512
+MESSAGE_FETCH_CONCURRENCY = 5
+DISCORD_MESSAGE_LIMIT = 2000
+SEARCH_PAGE_SIZE = 10
+
+# Additional guilds are configured in guilds.json as {"<guild_id>": {"<channel_name>": "<channel_id>", ...}, ...}
+GUILD_CHANNELS = {GUILD_ID: CHANNEL_CHOICES}
+if os.path.exists(GUILD_CONFIG_PATH):
+    with open(GUILD_CONFIG_PATH, "r") as config_file:
+        GUILD_CHANNELS |= {
+            int(guild_id): list(channels.items()) for guild_id, channels in json.load(config_file).items()
+        }
+
+
+def guild_resource_path(guild_id: int, filename: str) -> str:
+    """Return the path of a guild's resource file. The main guild keeps the original unprefixed paths."""
+    if guild_id == GUILD_ID:
+        return os.path.join(os.getcwd(), "resources", filename)
+    return os.path.join(os.getcwd(), "resources", str(guild_id), filename)
+
+
+databases = DatabaseRouter(
+    {
+        guild_id: Database(
+            guild_id=guild_id,
+            path=guild_resource_path(guild_id, "database.sqlite"),
+            earliest_audit_path=guild_resource_path(guild_id, "earliest_audit.txt"),
+            channels=channels,
+            owns_ingestion=INGESTION_MODE != "worker",
+            busy_timeout=DATABASE_BUSY_TIMEOUT,
+        )
+        for guild_id, channels in GUILD_CHANNELS.items()
+    },
+    DATABASE_IDLE_TIMEOUT,
+    MESSAGE_CACHE_SIZE,
+)
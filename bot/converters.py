@@ -17,6 +17,8 @@ You should have received a copy of the GNU General Public License along with Ken
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
+import re2
+
 
 def to_int(value: str) -> str | int:
     if not value:
@@ -24,6 +26,10 @@ def to_int(value: str) -> str | int:
     return int(value)
 
 
+def to_list(value: str) -> list[str]:
+    return list(filter(None, map(str.strip, value.split(","))))
+
+
 def convert_day(value: int) -> str:
     return f"{value:02d}"
 
@@ -57,3 +63,30 @@ def convert_epoch(epoch: float) -> datetime:
 
 def convert_single_quote_sql(text: str) -> str:
     return str.replace(text, "'", "''").rstrip()
+
+
+def convert_message_links(
+    raw_string: str, default_guild_id: int, default_channel_id: int
+) -> list[tuple[int, int, int]]:
+    """Convert a list of message IDs and jump links to guild, channel and message ID triples.
+
+    Arguments:
+      raw_string -- The message IDs or jump links, separated by commas or whitespace.
+      default_guild_id -- The guild ID to use for bare message IDs.
+      default_channel_id -- The channel ID to use for bare message IDs.
+
+    Returns:
+      A list of (guild_id, channel_id, message_id) tuples in the order they were given, without duplicates.
+      Links to direct messages have a guild ID of 0.
+    """
+    triples = []
+    for token in filter(None, re2.split(r"[\s,]+", raw_string)):
+        jump_link = re2.search(r"channels/(\d+|@me)/(\d+)/(\d+)", token)
+        if jump_link is not None:
+            guild_id = 0 if jump_link[1] == "@me" else int(jump_link[1])
+            triple = (guild_id, int(jump_link[2]), int(jump_link[3]))
+        else:
+            triple = (default_guild_id, default_channel_id, int(token))
+        if triple not in triples:
+            triples.append(triple)
+    return triples
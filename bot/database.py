@@ -1,4 +1,4 @@
-"""Defines a database class for variable storage.
+"""Defines database classes for variable storage and per-guild routing.
 Copyright © 2025 Dnd World
 
 This file is part of Kensa.
@@ -14,18 +14,306 @@ You should have received a copy of the GNU General Public License along with Ken
 <https://www.gnu.org/licenses/>.
 """
 
-from dataclasses import dataclass
+import asyncio
 import io
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator
 
 import aiosqlite
-from sqlalchemy import Engine
+from sqlalchemy import create_engine, Engine
+
+from bot.cache import MessageCache
+from bot.errors import UnknownGuildError
+from bot.name_index import NameIndex
+
+SCHEMA_SCRIPT = """BEGIN;
+            CREATE TABLE IF NOT EXISTS guild(message_id INTEGER, message_timestamp REAL, remaining_dtd INTEGER, old_purse REAL, new_purse REAL, lifestyle TEXT, injuries TEXT, dtd_type TEXT, user_id INTEGER, user_name TEXT, char_name TEXT, PRIMARY KEY(message_id DESC));
+            CREATE TABLE IF NOT EXISTS business(message_id INTEGER, message_timestamp REAL, remaining_dtd INTEGER, old_purse REAL, new_purse REAL, lifestyle TEXT, injuries TEXT, dtd_type TEXT, user_id INTEGER, user_name TEXT, char_name TEXT, PRIMARY KEY(message_id DESC));
+            CREATE TABLE IF NOT EXISTS ptw(message_id INTEGER, message_timestamp REAL, remaining_dtd INTEGER, old_purse REAL, new_purse REAL, lifestyle TEXT, injuries TEXT, dtd_type TEXT, user_id INTEGER, user_name TEXT, char_name TEXT, PRIMARY KEY(message_id DESC));
+            CREATE TABLE IF NOT EXISTS hrw(message_id INTEGER, message_timestamp REAL, remaining_dtd INTEGER, old_purse REAL, new_purse REAL, lifestyle TEXT, injuries TEXT, dtd_type TEXT, user_id INTEGER, user_name TEXT, char_name TEXT, PRIMARY KEY(message_id DESC));
+            CREATE TABLE IF NOT EXISTS odd(message_id INTEGER, message_timestamp REAL, remaining_dtd INTEGER, old_purse REAL, new_purse REAL, lifestyle TEXT, injuries TEXT, dtd_type TEXT, user_id INTEGER, user_name TEXT, char_name TEXT, PRIMARY KEY(message_id DESC));
+            CREATE TABLE IF NOT EXISTS lifestyle(message_id INTEGER, message_timestamp REAL, remaining_dtd INTEGER, old_purse REAL, new_purse REAL, lifestyle TEXT, injuries TEXT, dtd_type TEXT, user_id INTEGER, user_name TEXT, char_name TEXT, PRIMARY KEY(message_id DESC));
+            CREATE TABLE IF NOT EXISTS train(message_id INTEGER, message_timestamp REAL, remaining_dtd INTEGER, old_purse REAL, new_purse REAL, lifestyle TEXT, injuries TEXT, dtd_type TEXT, user_id INTEGER, user_name TEXT, char_name TEXT, xp_gained INTEGER, PRIMARY KEY(message_id DESC));
+            CREATE TABLE IF NOT EXISTS transactions(message_id INTEGER, message_timestamp REAL, remaining_dtd INTEGER, old_purse REAL, new_purse REAL, lifestyle TEXT, injuries TEXT, dtd_type TEXT, user_id INTEGER, user_name TEXT, char_name TEXT, description TEXT, PRIMARY KEY(message_id DESC));
+            CREATE VIEW IF NOT EXISTS train_no_xp AS SELECT message_id, message_timestamp, remaining_dtd, old_purse, new_purse, lifestyle, injuries, dtd_type, user_id, user_name, char_name FROM train;
+            CREATE VIEW IF NOT EXISTS transactions_no_desc AS SELECT message_id, message_timestamp, remaining_dtd, old_purse, new_purse, lifestyle, injuries, dtd_type, user_id, user_name, char_name FROM transactions;
+            DROP VIEW IF EXISTS raw_all;
+            CREATE VIEW raw_all AS SELECT * FROM guild UNION ALL SELECT * FROM business UNION ALL SELECT * FROM ptw UNION ALL SELECT * FROM hrw UNION ALL SELECT * FROM odd UNION ALL SELECT * FROM train_no_xp UNION ALL SELECT * FROM lifestyle UNION ALL SELECT * FROM transactions_no_desc;
+            DROP VIEW IF EXISTS raw_xp_appended;
+            CREATE VIEW raw_xp_appended AS SELECT raw_all.*, ifnull(train.xp_gained, 0) as xp_gained from raw_all left join train USING (message_id);
+            DROP VIEW IF EXISTS raw_appended;
+            CREATE VIEW raw_appended AS SELECT raw_xp_appended.*, ifnull(transactions.description, 'N/A') as transaction_description from raw_xp_appended left join transactions USING (message_id);
+            CREATE TABLE IF NOT EXISTS ingestion_jobs(job_id INTEGER PRIMARY KEY, kind TEXT, after REAL, status TEXT, error TEXT, requested_at REAL, finished_at REAL);
+            CREATE TABLE IF NOT EXISTS maintenance_runs(started_at REAL, duration REAL, bytes_reclaimed INTEGER, backup_path TEXT);
+            CREATE TABLE IF NOT EXISTS audit_exports(auditor_id INTEGER, filter_key TEXT, last_message_id INTEGER, PRIMARY KEY(auditor_id, filter_key));
+            CREATE TABLE IF NOT EXISTS message_payloads(message_id INTEGER PRIMARY KEY, channel_id INTEGER, message_timestamp REAL, content TEXT, embed TEXT);
+            CREATE VIRTUAL TABLE IF NOT EXISTS filtered_all USING FTS5(message_id, dtd_type, user_id, char_name, content=raw_appended, content_rowid=message_id);
+            INSERT INTO filtered_all(filtered_all) SELECT 'rebuild' WHERE NOT EXISTS (SELECT 1 FROM filtered_all_docsize);
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ai_guild AFTER INSERT ON guild BEGIN 
+                INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ai_business AFTER INSERT ON business BEGIN 
+                INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ai_ptw AFTER INSERT ON ptw BEGIN 
+                INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ai_hrw AFTER INSERT ON hrw BEGIN 
+                INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ai_odd AFTER INSERT ON odd BEGIN 
+                INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ai_train AFTER INSERT ON train BEGIN 
+                INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ai_lifestyle AFTER INSERT ON lifestyle BEGIN 
+                INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ai_transactions AFTER INSERT ON transactions BEGIN
+                INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ad_guild AFTER DELETE ON guild BEGIN 
+                INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ad_business AFTER DELETE ON business BEGIN 
+                INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ad_ptw AFTER DELETE ON ptw BEGIN 
+                INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ad_hrw AFTER DELETE ON hrw BEGIN 
+                INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ad_odd AFTER DELETE ON odd BEGIN 
+                INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ad_train AFTER DELETE ON train BEGIN 
+                INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ad_lifestyle AFTER DELETE ON lifestyle BEGIN 
+                INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS filtered_all_ad_transactions AFTER DELETE ON transactions BEGIN
+                INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
+            END;
+            CREATE VIRTUAL TABLE IF NOT EXISTS transaction_search USING FTS5(description, content=transactions, content_rowid=message_id, tokenize='trigram');
+            INSERT INTO transaction_search(transaction_search) SELECT 'rebuild' WHERE NOT EXISTS (SELECT 1 FROM transaction_search_docsize);
+            CREATE TRIGGER IF NOT EXISTS transaction_search_ai AFTER INSERT ON transactions BEGIN
+                INSERT INTO transaction_search(rowid, description) VALUES (new.message_id, new.description);
+            END;
+            CREATE TRIGGER IF NOT EXISTS transaction_search_ad AFTER DELETE ON transactions BEGIN
+                INSERT INTO transaction_search(transaction_search, rowid, description) VALUES ('delete', old.message_id, old.description);
+            END;
+        COMMIT;"""
+# Bumped whenever existing databases need a one-time migration when they are next opened
+SCHEMA_VERSION = 1
+
+
+def user_choice(user_id: int | str, user_name: str) -> tuple[str, str]:
+    """Return the autocomplete name and value of a user."""
+    return f"{user_name} ({user_id})", str(user_id)
 
 
 @dataclass
 class Database:
-    """Class to keep track of Kensa's SQLite databases"""
+    """Class to keep track of a guild's SQLite databases"""
 
+    guild_id: int = None
+    path: str = None
+    earliest_audit_path: str = None
+    channels: list[tuple[str, str]] = field(default_factory=list)
+    owns_ingestion: bool = True
+    busy_timeout: float = 5.0
     connection: aiosqlite.Connection = None
     earliest_audit: float = None
     engine: Engine = None
     file: io.TextIOBase = None
+    messages: MessageCache = None
+    char_names: NameIndex = None
+    user_names: NameIndex = None
+    names_indexed_through: int = 0
+    last_used: float = 0
+    last_maintenance: float = 0
+    active: int = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    ingestion_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    async def open(self, message_cache_size: int) -> None:
+        """Open the connections to the database and ensure its schema exists."""
+        logging.debug("Database connection attempt started for guild %s.", self.guild_id)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = await aiosqlite.connect(self.path, timeout=self.busy_timeout)
+        self.engine = create_engine(f"sqlite:///{self.path}", connect_args={"timeout": self.busy_timeout})
+        self.messages = MessageCache(message_cache_size)
+        try:
+            with open(self.earliest_audit_path, "r") as file:
+                self.earliest_audit = float(file.read())
+        except (FileNotFoundError, ValueError):
+            pass
+        # WAL lets the bot keep reading while the ingestion worker writes
+        await self.connection.executescript("PRAGMA journal_mode=WAL;")
+        await self.connection.executescript(SCHEMA_SCRIPT)
+        await self.migrate()
+        async with self.connection.execute("SELECT max(started_at) FROM maintenance_runs") as cursor:
+            self.last_maintenance = (await cursor.fetchone())[0] or 0
+        # The name indexes survive idle closes, so reopening only adds the names stored while closed
+        await self.refresh_name_indexes()
+        logging.debug("Database connection established for guild %s.", self.guild_id)
+
+    async def close(self) -> None:
+        """Close the connections to the database and persist the earliest audit if this process ingests."""
+        logging.debug("Attempting to close database connection for guild %s.", self.guild_id)
+        await self.connection.commit()
+        await self.connection.close()
+        self.engine.dispose()
+        if self.owns_ingestion:
+            self.write_earliest_audit()
+        self.connection = None
+        self.engine = None
+        self.messages = None
+        logging.debug("Database connection closed for guild %s.", self.guild_id)
+
+    async def migrate(self) -> None:
+        """Bring a database created by an older version of the bot up to the current schema version."""
+        async with self.connection.execute("PRAGMA user_version") as cursor:
+            (schema_version,) = await cursor.fetchone()
+        if schema_version >= SCHEMA_VERSION:
+            return
+        logging.info("Migrating database for guild %s to schema version %s.", self.guild_id, SCHEMA_VERSION)
+        # Before version 1, transactions only reached filtered_all through a rebuild on every startup
+        await self.connection.executescript(
+            f"""BEGIN;
+            INSERT INTO filtered_all(filtered_all) VALUES('rebuild');
+            PRAGMA user_version = {SCHEMA_VERSION};
+            COMMIT;"""
+        )
+
+    def write_earliest_audit(self) -> None:
+        with open(self.earliest_audit_path, "w") as file:
+            file.write(str(self.earliest_audit))
+
+    async def refresh_name_indexes(self) -> None:
+        """Add the names of rows stored since the last refresh to the autocomplete indexes.
+
+        The first refresh builds the indexes from the whole ledger. All rows are read before the indexes change, so
+        autocomplete never sees a partially built index.
+        """
+        indexed_from = self.names_indexed_through
+        async with self.connection.execute(
+            "SELECT char_name, max(message_id) FROM raw_all WHERE message_id > ? GROUP BY char_name",
+            (indexed_from,),
+        ) as cursor:
+            char_rows = await cursor.fetchall()
+        if not char_rows and self.char_names is not None:
+            return
+        indexed_through = max((message_id for _, message_id in char_rows), default=indexed_from)
+        async with self.connection.execute(
+            "SELECT DISTINCT user_id, user_name FROM raw_all "
+            "WHERE message_id > ? AND message_id <= ? AND user_id != 0",
+            (indexed_from, indexed_through),
+        ) as cursor:
+            user_rows = await cursor.fetchall()
+
+        char_names = NameIndex() if self.char_names is None else self.char_names
+        user_names = NameIndex() if self.user_names is None else self.user_names
+        for char_name, _ in char_rows:
+            if char_name is not None:
+                char_names.add(char_name, char_name)
+        for user_id, user_name in user_rows:
+            user_names.add(*user_choice(user_id, user_name))
+        self.char_names, self.user_names = char_names, user_names
+        # Keep the high-water mark if reindex_names_after moved it back while this refresh was reading
+        if self.names_indexed_through == indexed_from:
+            self.names_indexed_through = indexed_through
+        logging.debug(
+            "Indexed %s character names and %s user names for guild %s.",
+            len(self.char_names),
+            len(self.user_names),
+            self.guild_id,
+        )
+
+    def reindex_names_after(self, message_id: int) -> None:
+        """Make the next refresh revisit rows stored after a message, such as those added by a backfill."""
+        self.names_indexed_through = min(self.names_indexed_through, message_id)
+
+    def index_user(self, user_id: int | str, user_name: str) -> None:
+        self.user_names.add(*user_choice(user_id, user_name))
+
+    @property
+    def is_open(self) -> bool:
+        return self.connection is not None
+
+
+class DatabaseRouter:
+    """Class to route each guild to its own lazily opened database"""
+
+    def __init__(self, databases: dict[int, Database], idle_timeout: float, message_cache_size: int) -> None:
+        self.databases = databases
+        self.idle_timeout = idle_timeout
+        self.message_cache_size = message_cache_size
+
+    def __contains__(self, guild_id: int | None) -> bool:
+        return guild_id in self.databases
+
+    def get(self, guild_id: int | None) -> Database:
+        """Return the database of a guild without opening it.
+
+        Raises:
+          UnknownGuildError -- If the guild is not configured.
+        """
+        try:
+            return self.databases[guild_id]
+        except KeyError:
+            raise UnknownGuildError(guild_id)
+
+    def channels(self, guild_id: int | None) -> list[tuple[str, str]]:
+        """Return the registered channels of a guild, or an empty list for unknown guilds."""
+        database = self.databases.get(guild_id)
+        return [] if database is None else database.channels
+
+    @asynccontextmanager
+    async def acquire(self, guild_id: int | None) -> AsyncIterator[Database]:
+        """Open the guild's database if needed and keep it open for the duration of the context.
+
+        Arguments:
+          guild_id -- The ID of the guild whose database to use.
+
+        Raises:
+          UnknownGuildError -- If the guild is not configured.
+        """
+        database = self.get(guild_id)
+        async with database.lock:
+            if not database.is_open:
+                await database.open(self.message_cache_size)
+            database.active += 1
+        try:
+            yield database
+        finally:
+            database.active -= 1
+            database.last_used = time.monotonic()
+
+    async def close_idle(self) -> None:
+        """Close every open database that has not been used within the idle timeout."""
+        now = time.monotonic()
+        for database in self.databases.values():
+            async with database.lock:
+                if database.is_open and not database.active and now - database.last_used > self.idle_timeout:
+                    await database.close()
+
+    async def refresh_name_indexes(self) -> None:
+        """Refresh the name indexes of every open database without counting it as used."""
+        for database in self.databases.values():
+            async with database.lock:
+                if database.is_open:
+                    await database.refresh_name_indexes()
+
+    async def close_all(self) -> None:
+        for database in self.databases.values():
+            async with database.lock:
+                if database.is_open:
+                    await database.close()
@@ -53,3 +53,27 @@ class ArgumentError(Exception):
     @override
     def __str__(self) -> str:
         return self.message
+
+
+class UnknownGuildError(Exception):
+    """Exception raised when a command is used outside a guild Kensa is configured for"""
+
+    def __init__(self, guild_id: int | None) -> None:
+        self.message = f"Kensa is not configured for this server! (Guild ID: {guild_id})"
+        super().__init__(self.message)
+
+    @override
+    def __str__(self) -> str:
+        return self.message
+
+
+class IngestionError(Exception):
+    """Exception raised when the ingestion worker cannot complete a job"""
+
+    def __init__(self, message: str) -> None:
+        self.message = message
+        super().__init__(self.message)
+
+    @override
+    def __str__(self) -> str:
+        return self.message
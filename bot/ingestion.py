@@ -0,0 +1,327 @@
+"""Defines the ingestion of logging channel messages into the database.
+Copyright © 2025 Dnd World
+
+This file is part of Kensa.
+Kensa is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+later version.
+
+Kensa is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with Kensa. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import aiosqlite
+import hikari
+import re2
+
+from bot.cache import StoredMessage
+from bot.constants import INGESTION_JOB_POLL_INTERVAL, INGESTION_JOB_TIMEOUT, INGESTION_LOG_PAGE_SIZE
+from bot.database import Database
+from bot.errors import IngestionError, ParsingError
+from bot.maintenance import run_maintenance
+import bot.converters as cvt
+
+
+def log_ingestion_page(skipped: Counter, processed: int) -> None:
+    """Log and reset the tally of messages skipped since the last page."""
+    if skipped:
+        logging.debug("Skipped messages up to message %s: %s", processed, dict(skipped))
+    skipped.clear()
+
+
+async def update_tables(
+    database: Database, message_iterator: hikari.LazyIterator[hikari.Message], earliest_break: bool = False
+) -> None:
+    # Skipped messages are tallied per page of fetched messages rather than logged one by one
+    skipped = Counter()
+    processed = 0
+    async for message in message_iterator:
+        processed += 1
+        if processed % INGESTION_LOG_PAGE_SIZE == 0:
+            log_ingestion_page(skipped, processed)
+        try:
+            if (
+                (database.earliest_audit is not None)
+                and (message.timestamp.timestamp() > database.earliest_audit)
+                and earliest_break
+            ):
+                logging.debug("Breaking because data is already in tables.")
+                break
+
+            embed = message.embeds[0]
+            description = embed.description
+            if (
+                (description is None)
+            ):
+                skipped["no description"] += 1
+                continue
+
+            for field in embed.fields:
+                description += f"\n{field.name}\n{field.value}"
+
+            footer = embed.footer.text
+            try:
+                if embed.title is None:
+                    skipped["no title"] += 1
+                    continue
+                if (
+                    ("Coinpurse" in embed.title)
+                    or ("Coin Purse" in embed.title)
+                ):
+                    skipped["coin purse"] += 1
+                    continue
+                elif "High-Risk Work" in embed.title:
+                    to_audit = "hrw"
+                    dtd_type = "N/A"
+                elif footer is None:
+                    skipped["no footer"] += 1
+                    continue
+                elif "!guild" in footer:
+                    to_audit = "guild"
+                    dtd_type = re2.match(r"\w+", footer[7:])[0].replace("assasinate", "assassinate")
+                elif "!business" in footer:
+                    to_audit = "business"
+                    dtd_type = re2.search(r"Business Category:?\*\*:? ([^\n\r]+)", description)[1]
+                elif "!ptw" in footer:
+                    to_audit = "ptw"
+                    dtd_type = "Part-Time Work"
+                elif "!odd" in footer:
+                    to_audit = "odd"
+                    dtd_type = re2.match(r"\w+", footer[5:])[0]
+                elif "train" in footer:
+                    to_audit = "train"
+                    dtd_type = "Combat Training"
+                elif "lifestyle" in footer:
+                    to_audit = "lifestyle"
+                    dtd_type = "N/A"
+                elif "transaction" in footer:
+                    to_audit = "transactions"
+                    dtd_type = "N/A"
+                else:
+                    skipped["not searchable"] += 1
+                    continue
+            except Exception:
+                skipped["unclassifiable"] += 1
+                if skipped["unclassifiable"] == 1:
+                    logging.debug("Could not classify message %s", message.id, exc_info=True)
+                continue
+            if to_audit == "train":
+                query = f"INSERT INTO {to_audit} VALUES (:message_id,:timestamp,:dtd_remaining,:old_purse,:new_purse,:lifestyle,:injuries,:dtd_type,:user_id,:user_name,:char_name,:xp_gained);"
+            elif to_audit == "transactions":
+                query = f"INSERT INTO {to_audit} VALUES (:message_id,:timestamp,:dtd_remaining,:old_purse,:new_purse,:lifestyle,:injuries,:dtd_type,:user_id,:user_name,:char_name,:description);"
+            else:
+                query = f"INSERT INTO {to_audit} VALUES (:message_id,:timestamp,:dtd_remaining,:old_purse,:new_purse,:lifestyle,:injuries,:dtd_type,:user_id,:user_name,:char_name);"
+
+            message_id = message.id
+            message_timestamp = message.timestamp
+            dtd_remaining = description.count("◉")
+            old_purse = re2.search(r"(\d+\.\d+)gp -> \d+\.\d+gp \(", description)
+            new_purse = re2.search(r"-> (\d+\.\d+)", description)
+            lifestyle = re2.search(r"Lifestyle:?\*\*:? ([^\n\r]+)", description)
+            injuries = re2.search(r"Injuries:?\*\*:? ([^\n\r]+)", description)
+            user_id_and_name = re2.search(r"Player:?\*\*:? <@(\d+)> `([^`\n\r]+)", description)
+            char_name = re2.search(r"Character:?\*\*:? ([^\n]+)", description)
+            if char_name is None:
+                char_name = re2.match(r"(.+)makes a transaction!", embed.title)
+            if char_name is None:
+                skipped["no character"] += 1
+                continue
+            xp_gained = re2.search(r"XP Gained:?\*\*:? (\d+)", description)
+
+            try:
+                await database.connection.execute(
+                    query,
+                    {
+                        "message_id": message_id,
+                        "timestamp": message_timestamp.timestamp(),
+                        "dtd_remaining": dtd_remaining,
+                        "old_purse": 0 if old_purse is None else float(old_purse[1]),
+                        "new_purse": 0 if new_purse is None else float(new_purse[1]),
+                        "lifestyle": "Unknown" if lifestyle is None else lifestyle[1],
+                        "injuries": "None" if injuries is None else injuries[1],
+                        "dtd_type": dtd_type,
+                        "user_id": 0 if user_id_and_name is None else user_id_and_name[1],
+                        "user_name": "Unknown" if user_id_and_name is None else user_id_and_name[2],
+                        "char_name": char_name[1].strip(),
+                        "xp_gained": None if xp_gained is None else int(xp_gained[1]),
+                        "description": embed.description,
+                    },
+                )
+                await database.connection.execute(
+                    "INSERT OR IGNORE INTO message_payloads VALUES (:message_id,:channel_id,:timestamp,:content,:embed);",
+                    StoredMessage.from_message(message).to_row(),
+                )
+                await database.connection.commit()
+                database.char_names.add(char_name[1].strip(), char_name[1].strip())
+                if user_id_and_name is not None:
+                    database.index_user(user_id_and_name[1], user_id_and_name[2])
+            except aiosqlite.IntegrityError:
+                skipped["already stored"] += 1
+                continue
+            except TypeError as e:
+                print("ParsingError 1")
+                raise ParsingError(e, database.guild_id, message.channel_id, message.id)
+
+        # Handles if message does not have an Embed or if Embed doesn't have a Footer
+        except (IndexError, AttributeError):
+            skipped["no embed"] += 1
+        except TypeError as e:
+            print("parsingError 2")
+            raise ParsingError(e, database.guild_id, message.channel_id, message.id)
+    log_ingestion_page(skipped, processed)
+
+
+async def backfill(rest: hikari.api.RESTClient, database: Database, aware_date: datetime) -> None:
+    """Store every message sent after the given date until reaching messages already in the database.
+
+    Arguments:
+      rest -- The REST client to fetch messages with.
+      database -- The guild database to update.
+      aware_date -- The time-aware date to start reading the logging channels from.
+    """
+    for channel_name, channel_id in database.channels:
+        logging.debug(f"Fetching messages from channel: {channel_name}")
+        message_iterator: hikari.LazyIterator[hikari.Message] = rest.fetch_messages(int(channel_id), after=aware_date)
+
+        # Find messages not yet in database
+        await update_tables(database, message_iterator, True)
+        logging.debug(f"Fetched messages from channel: {channel_name}")
+
+    # Update variables to reflect new entries in database
+    try:
+        database.earliest_audit = min(aware_date.timestamp(), database.earliest_audit)
+    except TypeError:
+        database.earliest_audit = aware_date.timestamp()
+    logging.debug("Updated earliest audit")
+
+
+async def follow(rest: hikari.api.RESTClient, database: Database) -> None:
+    """Store every message sent after the most recent message in the database.
+
+    Arguments:
+      rest -- The REST client to fetch messages with.
+      database -- The guild database to update.
+    """
+    # Create cursor to find most recent timestamp in database
+    cursor = await database.connection.execute(
+        "SELECT message_timestamp FROM raw_all ORDER BY message_timestamp DESC LIMIT 1"
+    )
+    latest_sql_timestamp = await cursor.fetchone()
+    await cursor.close()
+    # A freshly created guild database has nothing newer to catch up on
+    if latest_sql_timestamp is None:
+        return
+    for channel_name, channel_id in database.channels:
+        message_iterator: hikari.LazyIterator[hikari.Message] = rest.fetch_messages(
+            int(channel_id),
+            after=cvt.convert_epoch(float(latest_sql_timestamp[0])),
+        )
+
+        # Find messages sent after SQL Database was last updated
+        await update_tables(database, message_iterator)
+
+
+async def catch_up(rest: hikari.api.RESTClient, database: Database, aware_date: datetime) -> None:
+    """Store every message sent after the given date that is not yet in the database.
+
+    Arguments:
+      rest -- The REST client to fetch messages with.
+      database -- The guild database to update.
+      aware_date -- The time-aware date to start reading the logging channels from.
+    """
+    # Maintenance waits on this lock so it never runs alongside ingestion
+    async with database.ingestion_lock:
+        await backfill(rest, database, aware_date)
+        await follow(rest, database)
+
+
+async def request_job(database: Database, kind: str, after: float | None = None) -> None:
+    """Queue a job for the ingestion worker and wait until it has finished.
+
+    Arguments:
+      database -- The guild database shared with the worker.
+      kind -- "catch_up" to store messages sent after the given time, "reset" to reset the earliest audit, or
+        "maintenance" to maintain the database.
+      after -- The UNIX epoch time to catch up from.
+
+    Raises:
+      IngestionError -- If the worker reports a failure or does not finish in time.
+    """
+    cursor = await database.connection.execute(
+        "INSERT INTO ingestion_jobs(kind, after, status, requested_at) VALUES (?, ?, 'pending', ?)",
+        (kind, after, time.time()),
+    )
+    job_id = cursor.lastrowid
+    await cursor.close()
+    await database.connection.commit()
+
+    deadline = time.monotonic() + INGESTION_JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(INGESTION_JOB_POLL_INTERVAL)
+        async with database.connection.execute(
+            "SELECT status, error FROM ingestion_jobs WHERE job_id = ?", (job_id,)
+        ) as cursor:
+            status, error = await cursor.fetchone()
+        if status == "done":
+            return
+        if status == "failed":
+            raise IngestionError(error)
+    raise IngestionError(f"The ingestion worker did not finish job {job_id} in time.")
+
+
+async def requeue_interrupted_jobs(database: Database) -> None:
+    """Return jobs left running by a worker that stopped mid-job to the queue."""
+    cursor = await database.connection.execute("UPDATE ingestion_jobs SET status = 'pending' WHERE status = 'running'")
+    if cursor.rowcount:
+        logging.info("Requeued %s interrupted ingestion jobs for guild %s.", cursor.rowcount, database.guild_id)
+    await cursor.close()
+    await database.connection.commit()
+
+
+async def process_jobs(rest: hikari.api.RESTClient, database: Database) -> None:
+    """Run every pending job queued for the guild by the bot.
+
+    Pending catch-up jobs are answered by a single pass starting from the earliest requested time.
+    """
+    async with database.connection.execute(
+        "SELECT job_id, kind, after FROM ingestion_jobs WHERE status = 'pending' ORDER BY job_id"
+    ) as cursor:
+        jobs = await cursor.fetchall()
+    if not jobs:
+        return
+    job_ids = [job_id for job_id, _, _ in jobs]
+    placeholders = ",".join("?" * len(job_ids))
+    await database.connection.execute(
+        f"UPDATE ingestion_jobs SET status = 'running' WHERE job_id IN ({placeholders})", job_ids
+    )
+    await database.connection.commit()
+
+    status, error = "done", None
+    try:
+        if any(kind == "reset" for _, kind, _ in jobs):
+            database.earliest_audit = None
+        catch_up_times = [after for _, kind, after in jobs if kind == "catch_up"]
+        if catch_up_times:
+            await catch_up(rest, database, datetime.fromtimestamp(min(catch_up_times), timezone.utc))
+        if any(kind == "maintenance" for _, kind, _ in jobs):
+            await run_maintenance(database)
+    except Exception as e:
+        logging.exception("Ingestion jobs %s failed for guild %s.", job_ids, database.guild_id)
+        status, error = "failed", str(e)
+    database.write_earliest_audit()
+
+    await database.connection.execute(
+        f"UPDATE ingestion_jobs SET status = ?, error = ?, finished_at = ? WHERE job_id IN ({placeholders})",
+        [status, error, time.time(), *job_ids],
+    )
+    await database.connection.commit()
@@ -0,0 +1,111 @@
+"""Defines scheduled maintenance of Kensa's SQLite databases.
+Copyright © 2025 Dnd World
+
+This file is part of Kensa.
+Kensa is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+later version.
+
+Kensa is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with Kensa. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+import glob
+import logging
+import os
+import time
+from datetime import datetime
+
+import aiosqlite
+
+from bot.constants import MAINTENANCE_BACKUP_COUNT, MAINTENANCE_IDLE_TIME, MAINTENANCE_INTERVAL
+from bot.database import Database
+
+
+def maintenance_due(database: Database) -> bool:
+    """Check whether an open database has been idle long enough for its overdue maintenance."""
+    return (
+        database.is_open
+        and not database.active
+        and not database.ingestion_lock.locked()
+        and time.monotonic() - database.last_used > MAINTENANCE_IDLE_TIME
+        and time.time() - database.last_maintenance > MAINTENANCE_INTERVAL
+    )
+
+
+async def bot_idle(database: Database) -> bool:
+    """Check, from the ingestion worker, that the bot has queued no job recently and none is outstanding."""
+    async with database.connection.execute(
+        "SELECT 1 FROM ingestion_jobs WHERE status IN ('pending', 'running') OR requested_at > ? LIMIT 1",
+        (time.time() - MAINTENANCE_IDLE_TIME,),
+    ) as cursor:
+        return await cursor.fetchone() is None
+
+
+async def database_size(database: Database) -> int:
+    async with database.connection.execute("PRAGMA page_count") as cursor:
+        (page_count,) = await cursor.fetchone()
+    async with database.connection.execute("PRAGMA page_size") as cursor:
+        (page_size,) = await cursor.fetchone()
+    return page_count * page_size
+
+
+async def run_maintenance(database: Database) -> tuple[float, int]:
+    """Gather planner statistics, merge FTS segments, reclaim free pages and back up the database.
+
+    Arguments:
+      database -- The open guild database to maintain.
+
+    Returns:
+      The duration of the run in seconds and the number of bytes reclaimed.
+    """
+    async with database.ingestion_lock:
+        logging.info("Database maintenance started for guild %s.", database.guild_id)
+        started_at = time.time()
+        await database.connection.commit()
+        size_before = await database_size(database)
+
+        await database.connection.execute("ANALYZE")
+        await database.connection.execute("PRAGMA optimize")
+        await database.connection.execute("INSERT INTO filtered_all(filtered_all) VALUES('optimize')")
+        await database.connection.execute("INSERT INTO transaction_search(transaction_search) VALUES('optimize')")
+        await database.connection.commit()
+
+        async with database.connection.execute("PRAGMA auto_vacuum") as cursor:
+            (auto_vacuum,) = await cursor.fetchone()
+        if auto_vacuum != 2:
+            # Switching to incremental mode only takes effect after one full vacuum
+            await database.connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await database.connection.execute("VACUUM")
+        else:
+            # executescript steps the pragma to completion, where execute would free a single page
+            await database.connection.executescript("PRAGMA incremental_vacuum;")
+        bytes_reclaimed = size_before - await database_size(database)
+
+        backup_directory = os.path.join(os.path.dirname(database.path), "backups")
+        os.makedirs(backup_directory, exist_ok=True)
+        backup_path = os.path.join(backup_directory, f"database-{datetime.now():%Y%m%d-%H%M%S}.sqlite")
+        async with aiosqlite.connect(backup_path) as backup:
+            await database.connection.backup(backup)
+        for old_backup in sorted(glob.glob(os.path.join(backup_directory, "database-*.sqlite")))[
+            :-MAINTENANCE_BACKUP_COUNT
+        ]:
+            os.remove(old_backup)
+
+        duration = time.time() - started_at
+        await database.connection.execute(
+            "INSERT INTO maintenance_runs VALUES (?, ?, ?, ?)", (started_at, duration, bytes_reclaimed, backup_path)
+        )
+        await database.connection.commit()
+        database.last_maintenance = started_at
+        logging.info(
+            "Database maintenance finished for guild %s in %.2fs, reclaiming %s bytes.",
+            database.guild_id,
+            duration,
+            bytes_reclaimed,
+        )
+        return duration, bytes_reclaimed
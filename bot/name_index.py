@@ -0,0 +1,73 @@
+"""Defines an in-memory index for fast autocomplete of names.
+Copyright © 2025 Dnd World
+
+This file is part of Kensa.
+Kensa is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+later version.
+
+Kensa is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with Kensa. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+from bisect import bisect_left, insort
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class NameIndex:
+    """Prefix and trigram index mapping displayed names to autocomplete values"""
+
+    def __init__(self) -> None:
+        self._entries: dict[str, tuple[str, str]] = {}
+        self._sorted_keys: list[str] = []
+        self._trigrams: dict[str, set[str]] = {}
+
+    def add(self, name: str, value: str) -> None:
+        """Add a name to the index if it is not already present.
+
+        Arguments:
+          name -- The name shown to the user and searched against.
+          value -- The value submitted when the name is chosen.
+        """
+        key = name.lower()
+        if key in self._entries:
+            return
+        self._entries[key] = (name, value)
+        insort(self._sorted_keys, key)
+        for trigram in trigrams(key):
+            self._trigrams.setdefault(trigram, set()).add(key)
+
+    def search(self, query: str, limit: int = 25) -> list[tuple[str, str]]:
+        """Find names starting with the query, followed by names containing it.
+
+        Arguments:
+          query -- The partial name typed by the user.
+          limit -- The maximum number of results to return.
+
+        Returns:
+          A list of (name, value) tuples.
+        """
+        query = query.lower().strip()
+        matches = []
+        start = bisect_left(self._sorted_keys, query)
+        for key in self._sorted_keys[start : start + limit]:
+            if not key.startswith(query):
+                break
+            matches.append(key)
+
+        if len(matches) < limit and len(query) >= 3:
+            candidates = set.intersection(*(self._trigrams.get(trigram, set()) for trigram in trigrams(query)))
+            prefixed = set(matches)
+            matches += sorted(key for key in candidates if key not in prefixed and query in key)[: limit - len(matches)]
+
+        return [self._entries[key] for key in matches]
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -14,27 +14,34 @@ You should have received a copy of the GNU General Public License along with Ken
 <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
 import io
 import logging
 from datetime import datetime
 
-import aiosqlite
 import crescent
 import hikari
 import polars as pl
 import re2
 import sys
+import zipfile
 
+from bot.cache import StoredMessage
 from bot.constants import (
-    CHANNEL_CHOICES,
-    database,
+    databases,
+    DISCORD_MESSAGE_LIMIT,
     Plugin,
+    GET_MESSAGE_LIMIT,
     GUILD_DTD_CHOICES,
-    GUILD_ID,
+    INGESTION_MODE,
+    MESSAGE_FETCH_CONCURRENCY,
     MONTH_CHOICES,
+    SEARCH_PAGE_SIZE,
 )
-from bot.errors import ArgumentError, ParsingError
+from bot.database import Database
+from bot.errors import ArgumentError, IngestionError, ParsingError
 import bot.converters as cvt
+import bot.ingestion as ingestion
 
 plugin = Plugin()
 audit_commands = crescent.Group("audit")
@@ -48,40 +55,173 @@ async def ping(ctx: crescent.Context) -> None:
     await ctx.respond(f"Pong!\nLatency: {current_latency * 1000:.2f} ms")
 
 
+def format_message(message: StoredMessage, content_type: int) -> str:
+    """Format a stored message for display in an audit response.
+
+    Arguments:
+      message -- The stored message to format.
+      content_type -- 0 to return the raw text of the message, 1 to return its embed contents.
+
+    Returns:
+      The formatted message, headed by its ID.
+    """
+    if content_type == 0:
+        return f"**Message {message.message_id}:**\n```{message.content}```\n"
+    embed = message.embed
+    if embed is None:
+        return f"**Message {message.message_id}:** No embed found.\n"
+    return (
+        f"**Message {message.message_id}:**\n"
+        f"**Title:** `{embed['title']}`\n"
+        f"**Description:** ```{embed['description']}```\n"
+        f"**Fields:** {''.join([f'\nField {i}: \n```{name}\n{value}```' for i, (name, value) in enumerate(embed['fields'])])}\n"
+        f"**Footer:** `{embed['footer']}`\n"
+        f"**Timestamp:** `{message.timestamp}`\n"
+    )
+
+
+async def autocomplete_channel(
+    ctx: crescent.AutocompleteContext, option: hikari.AutocompleteInteractionOption
+) -> list[tuple[str, str]]:
+    """Suggest the registered channels of the guild the command was used in."""
+    query = str(option.value).lower()
+    return [(name, channel_id) for name, channel_id in databases.channels(ctx.guild_id) if query in name.lower()][:25]
+
+
+async def autocomplete_char_name(
+    ctx: crescent.AutocompleteContext, option: hikari.AutocompleteInteractionOption
+) -> list[tuple[str, str]]:
+    """Suggest character names from the guild's in-memory name index."""
+    return autocomplete_name(ctx.guild_id, "char_names", str(option.value))
+
+
+async def autocomplete_user(
+    ctx: crescent.AutocompleteContext, option: hikari.AutocompleteInteractionOption
+) -> list[tuple[str, str]]:
+    """Suggest user IDs by user name from the guild's in-memory name index."""
+    return autocomplete_name(ctx.guild_id, "user_names", str(option.value))
+
+
+def autocomplete_name(guild_id: int | None, index_name: str, query: str) -> list[tuple[str, str]]:
+    # Never open the database here: that cannot meet Discord's autocomplete deadline and resets the idle timer
+    if guild_id not in databases or (index := getattr(databases.get(guild_id), index_name)) is None:
+        return []
+    results = index.search(query)
+    # Discord rejects choices whose name or value is longer than 100 characters
+    return [(name, value) for name, value in results if len(name) <= 100 and len(value) <= 100]
+
+
 @plugin.include
 @audit_commands.child
-@crescent.command(name="get_message", description="Performs a new audit of the server's logs.")
+@crescent.command(name="get_message", description="Fetches the contents of one or more messages.")
 class GetMessage:
     channel_id = crescent.option(
         str,
-        description="The ID of the message's channel.",
-        choices=CHANNEL_CHOICES,
+        description="The ID of the messages' channel. Ignored for jump links.",
+        autocomplete=autocomplete_channel,
     )
-    message_id = crescent.option(
+    message_ids = crescent.option(
         str,
-        description="The ID of the message.",
+        description="The IDs or jump links of the messages, separated by spaces or commas.",
     )
     content_type = crescent.option(
         int, description="The type of content you want to return", choices=[("message", 0), ("embed", 1)]
     )
 
+    async def lookup_stored(self, database: Database, message_ids: list[int]) -> dict[int, StoredMessage]:
+        """Find ingested messages in the database, then recently fetched messages in the message cache."""
+        found = {}
+        placeholders = ",".join("?" * len(message_ids))
+        async with database.connection.execute(
+            f"SELECT * FROM message_payloads WHERE message_id IN ({placeholders})", message_ids
+        ) as cursor:
+            async for row in cursor:
+                found[row[0]] = StoredMessage.from_row(row)
+        for message_id in message_ids:
+            if message_id not in found and (message := database.messages.get(message_id)) is not None:
+                found[message_id] = message
+        return found
+
+    async def fetch_missing(self, database: Database, pairs: list[tuple[int, int]]) -> dict[int, StoredMessage]:
+        """Fetch messages from Discord concurrently, leaving rate limiting to hikari's REST buckets."""
+        semaphore = asyncio.Semaphore(MESSAGE_FETCH_CONCURRENCY)
+
+        async def fetch(channel_id: int, message_id: int) -> StoredMessage | None:
+            async with semaphore:
+                try:
+                    message = await plugin.app.rest.fetch_message(channel_id, message_id)
+                except (hikari.NotFoundError, hikari.ForbiddenError):
+                    logging.debug("Could not fetch message %s in channel %s", message_id, channel_id)
+                    return None
+            return StoredMessage.from_message(message)
+
+        fetched = [message for message in await asyncio.gather(*(fetch(*pair) for pair in pairs)) if message]
+        # message_payloads only holds ingested log messages, so other fetches live in the bounded cache alone
+        for message in fetched:
+            database.messages.put(message)
+        return {message.message_id: message for message in fetched}
+
     async def callback(self, ctx: crescent.Context):
         logging.info("/audit get_message command called.")
-        message = await plugin.app.rest.fetch_message(int(self.channel_id), int(self.message_id))
-        if self.content_type == 0:
-            await ctx.respond(message)
+        try:
+            triples = cvt.convert_message_links(self.message_ids, ctx.guild_id, int(self.channel_id))
+        except ValueError:
+            raise ArgumentError([self.message_ids])
+        if not triples or len(triples) > GET_MESSAGE_LIMIT:
+            raise ArgumentError([self.message_ids])
+        # Only this guild's registered logging channels may be read, since results are stored in its database
+        allowed_channels = {int(channel_id) for _, channel_id in databases.channels(ctx.guild_id)}
+        if any(guild_id != ctx.guild_id or channel_id not in allowed_channels for guild_id, channel_id, _ in triples):
+            raise ArgumentError([self.channel_id, self.message_ids])
+        pairs = [(channel_id, message_id) for _, channel_id, message_id in triples]
+        await ctx.defer()
+
+        async with databases.acquire(ctx.guild_id) as database:
+            messages = await self.lookup_stored(database, [message_id for _, message_id in pairs])
+            missing = [pair for pair in pairs if pair[1] not in messages]
+            logging.debug("Found %s of %s messages locally.", len(pairs) - len(missing), len(pairs))
+            if missing:
+                messages |= await self.fetch_missing(database, missing)
+
+        output_string = "".join(
+            format_message(messages[message_id], self.content_type)
+            if message_id in messages
+            else f"**Message {message_id}:** Not found.\n"
+            for _, message_id in pairs
+        )
+        if len(output_string) <= DISCORD_MESSAGE_LIMIT:
+            await ctx.respond(output_string)
         else:
-            embed = message.embeds[0]
-            await ctx.respond(
-                f"**Title:** `{embed.title}`\n"
-                f"**Description:** ```{embed.description}```\n"
-                f"**Fields:** {''.join([f'\nField {i}: \n```{value.name}\n{value.value}```' for i, value in enumerate(embed.fields)])}\n"
-                f"**Footer:** `{embed.footer}`\n"
-                f"**Timestamp:** `{message.timestamp.timestamp()}`\n"
-            )
+            await ctx.respond(attachment=hikari.Bytes(io.StringIO(output_string), "messages.txt", "text/plain"))
         logging.info("/audit get_message command finished executing.")
 
 
+async def catch_up(database: Database, aware_date: datetime) -> None:
+    """Bring the database up to date, either in this process or through the ingestion worker."""
+    if INGESTION_MODE == "worker":
+        await ingestion.request_job(database, "catch_up", aware_date.timestamp())
+        # The worker may have backfilled rows older than the indexed names, which the next refresh picks up
+        database.reindex_names_after(int(hikari.Snowflake.from_datetime(aware_date)))
+    else:
+        await ingestion.catch_up(plugin.app.rest, database, aware_date)
+
+
+def fts_phrase(text: str) -> str:
+    """Quote text as a single FTS5 phrase, so characters such as - ' . ( and + are matched literally."""
+    return f'"{text.replace('"', '""')}"'
+
+
+def format_timestamps(sql_df: pl.DataFrame) -> pl.DataFrame:
+    """Replace the UNIX epoch message timestamps with EST/EDT date strings for export."""
+    time_column = sql_df.select(
+        pl.from_epoch("message_timestamp", time_unit="s")
+        .dt.convert_time_zone("America/New_York")
+        .cast(pl.String)
+        .replace("T", "")
+    ).to_series(0)
+    return sql_df.replace_column(1, time_column)
+
+
 @plugin.include
 @audit_commands.child
 @crescent.command(
@@ -110,149 +250,83 @@ class AuditDTDs:
     ).convert(cvt.to_int)
     month = crescent.option(str, description="The month after which to audit.", choices=MONTH_CHOICES)
     day = crescent.option(int, description="The day after which to audit.").convert(cvt.convert_day)
-    char_name = crescent.option(str, description="(Optional) The name of the character to audit.", default="")
-    user_id = crescent.option(str, description="(Optional) The ID of the User to audit.", default="").convert(
-        cvt.to_int
+    char_name = crescent.option(
+        str,
+        description="(Optional) The name of the character to audit.",
+        default="",
+        autocomplete=autocomplete_char_name,
     )
+    user_id = crescent.option(
+        str,
+        description="(Optional) The ID of the User to audit.",
+        default="",
+        autocomplete=autocomplete_user,
+    ).convert(cvt.to_int)
     dtd_type = crescent.option(
         str, description="(Optional) The DTD type you wish to audit.", default="", choices=GUILD_DTD_CHOICES
     )
+    delta = crescent.option(
+        bool, description="(Optional) Only return rows added since your last audit with these filters.", default=False
+    )
+    carry_over = crescent.option(
+        bool, description="(Optional) Summarize the purse and DTD where your last audit left off.", default=False
+    )
 
-    async def update_tables(
-        self, message_iterator: hikari.LazyIterator[hikari.Message], earliest_break: bool = False
-    ) -> None:
-        async for message in message_iterator:
-            try:
-                if (
-                    (database.earliest_audit is not None)
-                    and (message.timestamp.timestamp() > database.earliest_audit)
-                    and earliest_break
-                ):
-                    logging.debug("Breaking because data is already in tables.")
-                    break
-
-                embed = message.embeds[0]
-                description = embed.description
-                if (
-                    (description is None)
-                ):
-                    logging.debug("Issue with description: %s", description)
-                    continue
-
-                for field in embed.fields:
-                    description += f"\n{field.name}\n{field.value}"
-
-                footer = embed.footer.text
-                try:
-                    if embed.title is None:
-                        logging.debug("Title not set")
-                        continue
-                    if (
-                        ("Coinpurse" in embed.title)
-                        or ("Coin Purse" in embed.title)
-                    ):
-                        logging.debug("Issue with title: %s", embed.title)
-                        continue
-                    elif "High-Risk Work" in embed.title:
-                        to_audit = "hrw"
-                        dtd_type = "N/A"
-                    elif footer is None:
-                        logging.debug("Footer not set")
-                        continue
-                    elif "!guild" in footer:
-                        to_audit = "guild"
-                        dtd_type = re2.match(r"\w+", footer[7:])[0].replace("assasinate", "assassinate")
-                    elif "!business" in footer:
-                        to_audit = "business"
-                        dtd_type = re2.search(r"Business Category:?\*\*:? ([^\n\r]+)", description)[1]
-                    elif "!ptw" in footer:
-                        to_audit = "ptw"
-                        dtd_type = "Part-Time Work"
-                    elif "!odd" in footer:
-                        to_audit = "odd"
-                        dtd_type = re2.match(r"\w+", footer[5:])[0]
-                    elif "train" in footer:
-                        to_audit = "train"
-                        dtd_type = "Combat Training"
-                    elif "lifestyle" in footer:
-                        to_audit = "lifestyle"
-                        dtd_type = "N/A"
-                    elif "transaction" in footer:
-                        to_audit = "transactions"
-                        dtd_type = "N/A"
-                    else:
-                        logging.debug("Not searchable message: %s", footer)
-                        continue
-                except Exception as e:
-                    logging.debug(e, exc_info=True)
-                    continue
-                if to_audit == "train":
-                    query = f"INSERT INTO {to_audit} VALUES (:message_id,:timestamp,:dtd_remaining,:old_purse,:new_purse,:lifestyle,:injuries,:dtd_type,:user_id,:user_name,:char_name,:xp_gained);"
-                elif to_audit == "transactions":
-                    query = f"INSERT INTO {to_audit} VALUES (:message_id,:timestamp,:dtd_remaining,:old_purse,:new_purse,:lifestyle,:injuries,:dtd_type,:user_id,:user_name,:char_name,:description);"
-                else:
-                    query = f"INSERT INTO {to_audit} VALUES (:message_id,:timestamp,:dtd_remaining,:old_purse,:new_purse,:lifestyle,:injuries,:dtd_type,:user_id,:user_name,:char_name);"
-
-                message_id = message.id
-                message_timestamp = message.timestamp
-                dtd_remaining = description.count("◉")
-                old_purse = re2.search(r"(\d+\.\d+)gp -> \d+\.\d+gp \(", description)
-                new_purse = re2.search(r"-> (\d+\.\d+)", description)
-                lifestyle = re2.search(r"Lifestyle:?\*\*:? ([^\n\r]+)", description)
-                injuries = re2.search(r"Injuries:?\*\*:? ([^\n\r]+)", description)
-                user_id_and_name = re2.search(r"Player:?\*\*:? <@(\d+)> `([^`\n\r]+)", description)
-                char_name = re2.search(r"Character:?\*\*:? ([^\n]+)", description)
-                if char_name is None:
-                    char_name = re2.match(r"(.+)makes a transaction!", embed.title)
-                if char_name is None:
-                    continue
-                xp_gained = re2.search(r"XP Gained:?\*\*:? (\d+)", description)
+    @property
+    def filter_key(self) -> str:
+        # The start date is part of the key, so an earlier start date gets its own watermark after its backfill
+        return (
+            f"{self.year}-{self.month}-{self.day}|"
+            f"{self.dtd_type.strip().lower()}|{self.user_id}|{self.char_name.strip().lower()}"
+        )
 
-                try:
-                    await database.connection.execute(
-                        query,
-                        {
-                            "message_id": message_id,
-                            "timestamp": message_timestamp.timestamp(),
-                            "dtd_remaining": dtd_remaining,
-                            "old_purse": 0 if old_purse is None else float(old_purse[1]),
-                            "new_purse": 0 if new_purse is None else float(new_purse[1]),
-                            "lifestyle": "Unknown" if lifestyle is None else lifestyle[1],
-                            "injuries": "None" if injuries is None else injuries[1],
-                            "dtd_type": dtd_type,
-                            "user_id": 0 if user_id_and_name is None else user_id_and_name[1],
-                            "user_name": "Unknown" if user_id_and_name is None else user_id_and_name[2],
-                            "char_name": char_name[1].strip(),
-                            "xp_gained": None if xp_gained is None else int(xp_gained[1]),
-                            "description": embed.description,
-                        },
-                    )
-                    await database.connection.commit()
-                except aiosqlite.IntegrityError:
-                    continue
-                except TypeError as e:
-                    print("ParsingError 1")
-                    raise ParsingError(e, GUILD_ID, message.channel_id, message.id)
-
-            # Handles if message does not have an Embed or if Embed doesn't have a Footer
-            except (IndexError, AttributeError):
-                pass
-            except TypeError as e:
-                print("parsingError 2")
-                raise ParsingError(e, GUILD_ID, message.channel_id, message.id)
-
-    async def filter_tables(self, aware_date: datetime) -> pl.DataFrame:
+    async def last_exported(self, database: Database, auditor_id: int) -> int:
+        """Return the highest message ID already exported to the auditor with the current filters."""
+        async with database.connection.execute(
+            "SELECT last_message_id FROM audit_exports WHERE auditor_id = ? AND filter_key = ?",
+            (auditor_id, self.filter_key),
+        ) as cursor:
+            row = await cursor.fetchone()
+        return 0 if row is None else row[0]
+
+    async def record_export(self, database: Database, auditor_id: int, sql_df: pl.DataFrame) -> None:
+        if sql_df.is_empty():
+            return
+        await database.connection.execute(
+            "INSERT INTO audit_exports VALUES (:auditor_id, :filter_key, :last_message_id) "
+            "ON CONFLICT(auditor_id, filter_key) DO UPDATE SET "
+            "last_message_id = max(last_message_id, excluded.last_message_id)",
+            {"auditor_id": auditor_id, "filter_key": self.filter_key, "last_message_id": sql_df["message_id"].max()},
+        )
+        await database.connection.commit()
+
+    async def summarize_carry_over(self, database: Database, last_message_id: int) -> str:
+        async with database.connection.execute(
+            "SELECT message_timestamp, new_purse, remaining_dtd FROM raw_all WHERE message_id = ?", (last_message_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return "No previous audit with these filters."
+        timestamp, new_purse, remaining_dtd = row
+        return (
+            f"Carry-over from last audit (<t:{int(timestamp)}:f>): "
+            f"purse {new_purse:.2f}gp, {remaining_dtd} DTD remaining."
+        )
+
+    async def filter_tables(self, database: Database, aware_date: datetime, after_id: int = 0) -> pl.DataFrame:
         filtered_options_list = list(filter(None, map(str.strip, [self.dtd_type, str(self.user_id), self.char_name])))
+        # Ledger names such as Jean-Luc or D'Arc are otherwise parsed as FTS5 query syntax
+        search_terms = [fts_phrase(option) for option in filtered_options_list]
         num_options = len(filtered_options_list)
         match num_options:
             case 0:
-                query = "SELECT raw_appended.* from raw_appended INNER JOIN filtered_all ON raw_appended.message_id = filtered_all.rowid WHERE raw_appended.message_timestamp > :timestamp ORDER BY message_timestamp"
+                query = "SELECT raw_appended.* from raw_appended INNER JOIN filtered_all ON raw_appended.message_id = filtered_all.rowid WHERE raw_appended.message_timestamp > :timestamp AND filtered_all.rowid > :after_id ORDER BY message_timestamp"
             case 1:
-                query = "SELECT raw_appended.* from raw_appended INNER JOIN filtered_all ON raw_appended.message_id = filtered_all.rowid WHERE filtered_all MATCH :search_1 AND raw_appended.message_timestamp > :timestamp ORDER BY message_timestamp"
+                query = "SELECT raw_appended.* from raw_appended INNER JOIN filtered_all ON raw_appended.message_id = filtered_all.rowid WHERE filtered_all MATCH :search_1 AND raw_appended.message_timestamp > :timestamp AND filtered_all.rowid > :after_id ORDER BY message_timestamp"
             case 2:
-                query = "SELECT raw_appended.* from raw_appended INNER JOIN filtered_all ON raw_appended.message_id = filtered_all.rowid WHERE filtered_all MATCH :search_1 AND filtered_all MATCH :search_2 AND raw_appended.message_timestamp > :timestamp ORDER BY message_timestamp"
+                query = "SELECT raw_appended.* from raw_appended INNER JOIN filtered_all ON raw_appended.message_id = filtered_all.rowid WHERE filtered_all MATCH :search_1 AND filtered_all MATCH :search_2 AND raw_appended.message_timestamp > :timestamp AND filtered_all.rowid > :after_id ORDER BY message_timestamp"
             case 3:
-                query = "SELECT raw_appended.* from raw_appended INNER JOIN filtered_all ON raw_appended.message_id = filtered_all.rowid WHERE filtered_all MATCH :search_1 AND filtered_all MATCH :search_2 AND filtered_all MATCH :search_3 AND raw_appended.message_timestamp > :timestamp ORDER BY message_timestamp"
+                query = "SELECT raw_appended.* from raw_appended INNER JOIN filtered_all ON raw_appended.message_id = filtered_all.rowid WHERE filtered_all MATCH :search_1 AND filtered_all MATCH :search_2 AND filtered_all MATCH :search_3 AND raw_appended.message_timestamp > :timestamp AND filtered_all.rowid > :after_id ORDER BY message_timestamp"
             case _:
                 raise ArgumentError(filtered_options_list)
 
@@ -262,71 +336,197 @@ class AuditDTDs:
             execute_options={
                 "parameters": {
                     "timestamp": aware_date.timestamp(),
-                    "search_1": filtered_options_list[0] if num_options > 0 else None,
-                    "search_2": filtered_options_list[1] if num_options > 1 else None,
-                    "search_3": filtered_options_list[2] if num_options > 2 else None,
+                    "after_id": after_id,
+                    "search_1": search_terms[0] if num_options > 0 else None,
+                    "search_2": search_terms[1] if num_options > 1 else None,
+                    "search_3": search_terms[2] if num_options > 2 else None,
                 }
             },
         )
 
     async def callback(self, ctx: crescent.Context) -> None:
         logging.info("/audit full command called.")
+        # Without a character or player, the last exported row could belong to anyone
+        if self.carry_over and not (str(self.user_id).strip() or self.char_name.strip()):
+            raise ArgumentError(["carry_over"])
         await ctx.respond("Audit started. This may take a few minutes. Please wait...")
         aware_date = cvt.convert_date(f"{self.year}-{self.month}-{self.day}")
-        for channel_name, channel_id in CHANNEL_CHOICES:
-            logging.debug(f"Fetching messages from channel: {channel_name}")
-            message_iterator: hikari.LazyIterator[hikari.Message] = plugin.app.rest.fetch_messages(
-                int(channel_id), after=aware_date
-            )
+        async with databases.acquire(ctx.guild_id) as database:
+            await catch_up(database, aware_date)
+            last_message_id = await self.last_exported(database, ctx.user.id)
 
-            # Find messages not yet in database
-            await self.update_tables(message_iterator, True)
-            logging.debug(f"Fetched messages from channel: {channel_name}")
+            # Fetch all messages stored in database, or only those newer than the last export in delta mode
+            sql_df = await self.filter_tables(database, aware_date, last_message_id if self.delta else 0)
+            summary = await self.summarize_carry_over(database, last_message_id) if self.carry_over else None
 
-        # Update variables to reflect new entries in database
-        try:
-            database.earliest_audit = min(aware_date.timestamp(), database.earliest_audit)
-        except TypeError:
-            database.earliest_audit = aware_date.timestamp()
-        logging.debug("Updated earliest audit")
-
-        # Create cursor to find most recent timestamp in database
-        cursor = await database.connection.execute(
-            "SELECT message_timestamp FROM raw_all ORDER BY message_timestamp DESC LIMIT 1"
-        )
-        latest_sql_timestamp = await cursor.fetchone()
-        for channel_name, channel_id in CHANNEL_CHOICES:
-            message_iterator: hikari.LazyIterator[hikari.Message] = plugin.app.rest.fetch_messages(
-                int(channel_id),
-                after=cvt.convert_epoch(float(latest_sql_timestamp[0])),
+        output_string = format_timestamps(sql_df).write_csv()
+        output_file = io.StringIO(output_string)
+        await ctx.respond(
+            summary,
+            attachment=hikari.Bytes(
+                output_file,
+                "audit.csv",
+                "text/csv",
             )
+        )
+        # Only advance the delta watermark once the auditor has actually received the rows
+        if self.delta:
+            async with databases.acquire(ctx.guild_id) as database:
+                await self.record_export(database, ctx.user.id, sql_df)
+        logging.info(f"/audit full finished executing.")
 
-            # Find messages sent after SQL Database was last updated
-            await self.update_tables(message_iterator)
 
-        await cursor.close()
+@plugin.include
+@audit_commands.child
+@crescent.command(
+    name="batch",
+    description="Audit several characters and players at once",
+)
+class BatchAudit:
+    year = crescent.option(
+        str,
+        description="The year after which to audit.",
+    ).convert(cvt.to_int)
+    month = crescent.option(str, description="The month after which to audit.", choices=MONTH_CHOICES)
+    day = crescent.option(int, description="The day after which to audit.").convert(cvt.convert_day)
+    char_names = crescent.option(
+        str, description="(Optional) The names of the characters to audit, separated by commas.", default=""
+    ).convert(cvt.to_list)
+    user_ids = crescent.option(
+        str, description="(Optional) The IDs of the Users to audit, separated by commas.", default=""
+    ).convert(cvt.to_list)
+    dtd_type = crescent.option(
+        str, description="(Optional) The DTD type you wish to audit.", default="", choices=GUILD_DTD_CHOICES
+    )
 
-        # Fetch all messages stored in database
+    async def filter_tables(self, database: Database, aware_date: datetime, user_ids: list[int]) -> pl.DataFrame:
+        """Fetch the rows of every target in a single query."""
+        parameters = {"timestamp": aware_date.timestamp(), "dtd_type": self.dtd_type}
+        parameters |= {f"char_{i}": char_name.lower() for i, char_name in enumerate(self.char_names)}
+        parameters |= {f"user_{i}": user_id for i, user_id in enumerate(user_ids)}
+        char_placeholders = ",".join(f":char_{i}" for i in range(len(self.char_names)))
+        user_placeholders = ",".join(f":user_{i}" for i in range(len(user_ids)))
+        query = (
+            "SELECT * FROM raw_appended WHERE message_timestamp > :timestamp "
+            f"AND (lower(char_name) IN ({char_placeholders}) OR user_id IN ({user_placeholders})) "
+            f"{'AND dtd_type = :dtd_type ' if self.dtd_type else ''}"
+            "ORDER BY message_timestamp"
+        )
+        # An empty result would otherwise come back as Null columns, which cannot be partitioned by string
+        return pl.read_database(
+            query,
+            database.engine,
+            execute_options={"parameters": parameters},
+            schema_overrides={"message_timestamp": pl.Float64, "user_id": pl.Int64, "char_name": pl.String},
+        )
 
-        sql_df = await self.filter_tables(aware_date)
+    async def callback(self, ctx: crescent.Context) -> None:
+        logging.info("/audit batch command called.")
+        try:
+            user_ids = [int(user_id) for user_id in self.user_ids]
+        except ValueError:
+            raise ArgumentError(self.user_ids)
+        if not self.char_names and not user_ids:
+            raise ArgumentError([])
+        await ctx.respond("Audit started. This may take a few minutes. Please wait...")
+        aware_date = cvt.convert_date(f"{self.year}-{self.month}-{self.day}")
+        async with databases.acquire(ctx.guild_id) as database:
+            await catch_up(database, aware_date)
+            sql_df = await self.filter_tables(database, aware_date, user_ids)
 
-        time_column = sql_df.select(
-            pl.from_epoch("message_timestamp", time_unit="s")
-            .dt.convert_time_zone("America/New_York")
-            .cast(pl.String)
-            .replace("T", "")
-        ).to_series(0)
-        sql_df.replace_column(1, time_column)
-        output_string = sql_df.write_csv()
-        output_file = io.StringIO(output_string)
+        sql_df = format_timestamps(sql_df)
+        by_char_name = sql_df.with_columns(pl.col("char_name").str.to_lowercase().alias("target")).partition_by(
+            "target", as_dict=True, include_key=False
+        )
+        by_user_id = sql_df.partition_by("user_id", as_dict=True, maintain_order=True)
+        exports = {f"char_{char_name}": by_char_name.get((char_name.lower(),)) for char_name in self.char_names}
+        exports |= {f"user_{user_id}": by_user_id.get((user_id,)) for user_id in user_ids}
+
+        output_file = io.BytesIO()
+        with zipfile.ZipFile(output_file, "w", zipfile.ZIP_DEFLATED) as archive:
+            # The index keeps entry names unique when sanitizing makes two targets look alike
+            for index, (target, target_df) in enumerate(exports.items(), start=1):
+                target_df = sql_df.clear() if target_df is None else target_df
+                archive.writestr(f"{index:02d}_{re2.sub(r'[^\w-]+', '_', target)}.csv", target_df.write_csv())
+        output_file.seek(0)
         await ctx.respond(
             attachment=hikari.Bytes(
                 output_file,
-                "audit.csv",
-                "text/csv",
+                "audit.zip",
+                "application/zip",
             )
         )
-        logging.info(f"/audit full finished executing.")
+        logging.info("/audit batch finished executing.")
+
+
+@plugin.include
+@audit_commands.child
+@crescent.command(
+    name="search",
+    description="Search the descriptions of transactions",
+)
+class AuditSearch:
+    query = crescent.option(str, description="The text to search for, at least 3 characters long.")
+    after = crescent.option(str, description="(Optional) The date after which to search, as YYYY-MM-DD.", default="")
+    before = crescent.option(str, description="(Optional) The date before which to search, as YYYY-MM-DD.", default="")
+    cursor = crescent.option(str, description="(Optional) The cursor of the page to show.", default="")
+
+    async def search_transactions(
+        self, database: Database, after: float, before: float, score: float, message_id: int
+    ) -> list[tuple]:
+        """Return the next page of matches ranked by bm25, starting after the given (score, message_id) key."""
+        async with database.connection.execute(
+            "SELECT * FROM (SELECT transactions.message_id, transactions.message_timestamp, transactions.char_name, "
+            "snippet(transaction_search, 0, '**', '**', '...', 48) AS excerpt, bm25(transaction_search) AS score "
+            "FROM transaction_search INNER JOIN transactions ON transactions.message_id = transaction_search.rowid "
+            "WHERE transaction_search MATCH :query AND transactions.message_timestamp BETWEEN :after AND :before) "
+            "WHERE score > :score OR (score = :score AND message_id > :message_id) "
+            "ORDER BY score, message_id LIMIT :limit",
+            {
+                "query": fts_phrase(self.query),
+                "after": after,
+                "before": before,
+                "score": score,
+                "message_id": message_id,
+                "limit": SEARCH_PAGE_SIZE,
+            },
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def callback(self, ctx: crescent.Context) -> None:
+        logging.info("/audit search command called.")
+        if len(self.query.strip()) < 3:
+            raise ArgumentError([self.query])
+        try:
+            after = cvt.convert_date(self.after).timestamp() if self.after else 0
+            before = cvt.convert_date(self.before).timestamp() if self.before else float("inf")
+            score, message_id = float("-inf"), 0
+            if self.cursor:
+                # Snowflakes exceed float precision, so the message ID must be parsed as an integer
+                score_str, id_str = self.cursor.split(":", 1)
+                score, message_id = float(score_str), int(id_str)
+        except ValueError:
+            raise ArgumentError([self.after, self.before, self.cursor])
+
+        async with databases.acquire(ctx.guild_id) as database:
+            results = await self.search_transactions(database, after, before, score, message_id)
+
+        if not results:
+            await ctx.respond("No matching transactions found.")
+            return
+        lines = [
+            f"<t:{int(timestamp)}:d> **{char_name}** ({message_id}): {excerpt}"
+            for message_id, timestamp, char_name, excerpt, _ in results
+        ]
+        if len(results) == SEARCH_PAGE_SIZE:
+            last_message_id, _, _, _, last_score = results[-1]
+            lines.append(f"Next page cursor: `{last_score!r}:{last_message_id}`")
+        output_string = "\n".join(lines)
+        if len(output_string) <= DISCORD_MESSAGE_LIMIT:
+            await ctx.respond(output_string)
+        else:
+            await ctx.respond(attachment=hikari.Bytes(io.StringIO(output_string), "search.txt", "text/plain"))
+        logging.info("/audit search finished executing.")
 
 
 @plugin.include
@@ -335,6 +535,12 @@ async def catch_argument_error(exc: ArgumentError, ctx: crescent.Context) -> Non
     await ctx.respond(exc)
 
 
+@plugin.include
+@crescent.catch_command(IngestionError)
+async def catch_ingestion_error(exc: IngestionError, ctx: crescent.Context) -> None:
+    await ctx.respond(f"Unexpected error! Please provide the following information to <@657638997941813258>:\n{exc}")
+
+
 @plugin.include
 @crescent.catch_command(ParsingError)
 async def catch_parsing_error(exc: ParsingError, ctx: crescent.Context) -> None:
@@ -14,105 +14,75 @@ You should have received a copy of the GNU General Public License along with Ken
 <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
 import logging
 
 import aiosqlite
 import crescent
-from sqlalchemy import create_engine
 import hikari
 
 from bot.constants import (
-    database,
+    databases,
     DEV_IDS,
+    INGESTION_MODE,
     Plugin,
-    EARLIEST_AUDIT_PATH,
-    MAIN_DATABASE_PATH,
 )
-from bot.errors import InsufficientPrivilegesError
+from bot.errors import InsufficientPrivilegesError, UnknownGuildError
+from bot.maintenance import maintenance_due, run_maintenance
+import bot.ingestion as ingestion
 
 plugin = Plugin()
 database_commands = crescent.Group("database")
+idle_task: asyncio.Task | None = None
+index_task: asyncio.Task | None = None
 
 
 @plugin.include
 @crescent.event
 async def start_database(event: hikari.StartingEvent) -> None:
-    logging.debug(f"Database connection attempt started.")
-    database.connection = await aiosqlite.connect(MAIN_DATABASE_PATH)
-    database.engine = create_engine(f"sqlite:///{MAIN_DATABASE_PATH}")
-    with open(EARLIEST_AUDIT_PATH, "r") as file:
+    global idle_task, index_task
+    # Guild databases are otherwise opened lazily on first use
+    idle_task = asyncio.create_task(close_idle_databases())
+    index_task = asyncio.create_task(build_name_indexes())
+
+
+async def build_name_indexes() -> None:
+    """Open each guild database once so its autocomplete indexes are ready; the idle closer closes it again."""
+    for guild_id in databases.databases:
         try:
-            database.earliest_audit = float(file.read())
-        except ValueError:
-            pass
-    await database.connection.executescript(
-        """BEGIN;
-                CREATE VIEW IF NOT EXISTS train_no_xp AS SELECT message_id, message_timestamp, remaining_dtd, old_purse, new_purse, lifestyle, injuries, dtd_type, user_id, user_name, char_name FROM train;
-                CREATE VIEW IF NOT EXISTS transactions_no_desc AS SELECT message_id, message_timestamp, remaining_dtd, old_purse, new_purse, lifestyle, injuries, dtd_type, user_id, user_name, char_name FROM transactions;
-                DROP VIEW IF EXISTS raw_all;
-                CREATE VIEW raw_all AS SELECT * FROM guild UNION SELECT * FROM business UNION SELECT * FROM ptw UNION SELECT * FROM hrw UNION SELECT * FROM odd UNION SELECT * FROM train_no_xp UNION SELECT * FROM lifestyle UNION SELECT * FROM transactions_no_desc;
-                DROP VIEW IF EXISTS raw_xp_appended;
-                CREATE VIEW raw_xp_appended AS SELECT raw_all.*, ifnull(train.xp_gained, 0) as xp_gained from raw_all left join train USING (message_id);
-                DROP VIEW IF EXISTS raw_appended;
-                CREATE VIEW raw_appended AS SELECT raw_xp_appended.*, ifnull(transactions.description, 'N/A') as transaction_description from raw_xp_appended left join transactions USING (message_id);
-                CREATE VIRTUAL TABLE IF NOT EXISTS filtered_all USING FTS5(message_id, dtd_type, user_id, char_name, content=raw_appended, content_rowid=message_id);
-                INSERT INTO filtered_all(filtered_all) VALUES('rebuild');
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ai_guild AFTER INSERT ON guild BEGIN 
-                    INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ai_business AFTER INSERT ON business BEGIN 
-                    INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ai_ptw AFTER INSERT ON ptw BEGIN 
-                    INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ai_hrw AFTER INSERT ON hrw BEGIN 
-                    INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ai_odd AFTER INSERT ON odd BEGIN 
-                    INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ai_train AFTER INSERT ON train BEGIN 
-                    INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ai_lifestyle AFTER INSERT ON lifestyle BEGIN 
-                    INSERT INTO filtered_all(rowid, dtd_type, user_id, char_name) VALUES (new.message_id, new.dtd_type, new.user_id, new.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ad_guild AFTER DELETE ON guild BEGIN 
-                    INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ad_business AFTER DELETE ON business BEGIN 
-                    INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ad_ptw AFTER DELETE ON ptw BEGIN 
-                    INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ad_hrw AFTER DELETE ON hrw BEGIN 
-                    INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ad_odd AFTER DELETE ON odd BEGIN 
-                    INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ad_train AFTER DELETE ON train BEGIN 
-                    INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
-                END;
-                CREATE TRIGGER IF NOT EXISTS filtered_all_ad_lifestyle AFTER DELETE ON lifestyle BEGIN 
-                    INSERT INTO filtered_all(filtered_all, rowid, dtd_type, user_id, char_name) VALUES ('delete', old.message_id, old.dtd_type, old.user_id, old.char_name);
-                END;
-            COMMIT;"""
-    )
-    logging.debug(f"Database connection established.")
+            async with databases.acquire(guild_id):
+                pass
+        except Exception:
+            logging.exception("Could not build name indexes for guild %s.", guild_id)
+
+
+async def close_idle_databases() -> None:
+    while True:
+        await asyncio.sleep(60)
+        for database in databases.databases.values():
+            # The ingestion worker maintains the databases itself when it owns ingestion
+            if INGESTION_MODE != "worker" and maintenance_due(database):
+                try:
+                    async with databases.acquire(database.guild_id):
+                        await run_maintenance(database)
+                except Exception:
+                    logging.exception("Database maintenance failed for guild %s.", database.guild_id)
+        # Names stored by the ingestion worker only reach this process's autocomplete indexes through a refresh
+        if INGESTION_MODE == "worker":
+            try:
+                await databases.refresh_name_indexes()
+            except Exception:
+                logging.exception("Could not refresh name indexes.")
+        await databases.close_idle()
 
 
 @plugin.include
 @crescent.event
 async def close_database(event: hikari.StoppingEvent) -> None:
-    logging.debug(f"Attempting to close database connection.")
-    await database.connection.commit()
-    await database.connection.close()
-    with open(EARLIEST_AUDIT_PATH, "w") as file:
-        file.write(str(database.earliest_audit))
-    logging.debug(f"Database connection closed.")
+    for task in (idle_task, index_task):
+        if task is not None:
+            task.cancel()
+    await databases.close_all()
 
 
 @plugin.include
@@ -125,23 +95,24 @@ class CreateDatabase:
         if ctx.user.mention not in DEV_IDS:
             raise InsufficientPrivilegesError("Insufficient Permissions!")
 
-        await database.connection.execute(
-            """CREATE TABLE IF NOT EXISTS %s(
-                    message_id INTEGER,
-                    message_timestamp REAL,
-                    remaining_dtd INTEGER,
-                    old_purse REAL,
-                    new_purse REAL,
-                    lifestyle TEXT,
-                    injuries TEXT,
-                    dtd_type TEXT,
-                    user_id INTEGER,
-                    user_name TEXT,
-                    char_name TEXT,
-                    PRIMARY KEY(message_id DESC)
-            );"""
-            % f"'{self.table_name.replace("'", "''")}'"
-        )
+        async with databases.acquire(ctx.guild_id) as database:
+            await database.connection.execute(
+                """CREATE TABLE IF NOT EXISTS %s(
+                        message_id INTEGER,
+                        message_timestamp REAL,
+                        remaining_dtd INTEGER,
+                        old_purse REAL,
+                        new_purse REAL,
+                        lifestyle TEXT,
+                        injuries TEXT,
+                        dtd_type TEXT,
+                        user_id INTEGER,
+                        user_name TEXT,
+                        char_name TEXT,
+                        PRIMARY KEY(message_id DESC)
+                );"""
+                % f"'{self.table_name.replace("'", "''")}'"
+            )
         await ctx.respond("Database created.")
 
 
@@ -152,7 +123,11 @@ class CreateDatabase:
 async def reset_latest_audit_info(ctx: crescent.Context) -> None:
     if ctx.user.mention not in DEV_IDS:
         raise InsufficientPrivilegesError("Insufficient Permissions!")
-    database.earliest_audit = None
+    async with databases.acquire(ctx.guild_id) as database:
+        if INGESTION_MODE == "worker":
+            await ingestion.request_job(database, "reset")
+        else:
+            database.earliest_audit = None
     await ctx.respond("Reset Earliest Audit Info!")
 
 
@@ -168,13 +143,50 @@ class QueryDatabase:
     async def callback(self, ctx: crescent.Context) -> None:
         if ctx.user.mention not in DEV_IDS:
             raise InsufficientPrivilegesError("Insufficient Permissions!")
-        async with aiosqlite.connect(MAIN_DATABASE_PATH) as c:
+        async with aiosqlite.connect(databases.get(ctx.guild_id).path) as c:
             async with c.execute(self.query) as cursor:
                 result = await cursor.fetchall()
         await ctx.respond(result)
 
 
+@plugin.include
+@database_commands.child
+@crescent.command(name="maintenance", description="Shows recent database maintenance runs")
+class Maintenance:
+    run_now = crescent.option(bool, description="Run maintenance now instead of waiting for idle time", default=False)
+
+    async def callback(self, ctx: crescent.Context) -> None:
+        if ctx.user.mention not in DEV_IDS:
+            raise InsufficientPrivilegesError("Insufficient Permissions!")
+        await ctx.defer()
+        async with databases.acquire(ctx.guild_id) as database:
+            if self.run_now and INGESTION_MODE == "worker":
+                # Only the worker knows whether it is ingesting, so it runs the maintenance between its own writes
+                await ingestion.request_job(database, "maintenance")
+            elif self.run_now:
+                await run_maintenance(database)
+            async with database.connection.execute(
+                "SELECT started_at, duration, bytes_reclaimed FROM maintenance_runs ORDER BY started_at DESC LIMIT 5"
+            ) as cursor:
+                runs = await cursor.fetchall()
+        if not runs:
+            await ctx.respond("No maintenance has run yet.")
+            return
+        await ctx.respond(
+            "\n".join(
+                f"<t:{int(started_at)}:f>: {duration:.2f}s, {bytes_reclaimed / 1024:.0f} KiB reclaimed"
+                for started_at, duration, bytes_reclaimed in runs
+            )
+        )
+
+
 @plugin.include
 @crescent.catch_command(InsufficientPrivilegesError)
 async def catch_permission_error(exc: InsufficientPrivilegesError, ctx: crescent.Context) -> None:
     await ctx.respond(exc)
+
+
+@plugin.include
+@crescent.catch_command(UnknownGuildError)
+async def catch_unknown_guild_error(exc: UnknownGuildError, ctx: crescent.Context) -> None:
+    await ctx.respond(exc)
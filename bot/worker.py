@@ -0,0 +1,91 @@
+"""Defines the ingestion worker, which stores logging channel messages separately from the gateway bot.
+Copyright © 2025 Dnd World
+
+This file is part of Kensa.
+Kensa is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+later version.
+
+Kensa is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with Kensa. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import logging
+import logging.config
+import time
+
+import hikari
+
+from bot.constants import DISCORD_TOKEN, databases, INGESTION_POLL_INTERVAL, LOGGING_CONFIG, MAINTENANCE_INTERVAL
+from bot.maintenance import bot_idle, run_maintenance
+import bot.ingestion as ingestion
+
+
+async def ingest_guild(rest: hikari.api.RESTClient, guild_id: int) -> None:
+    """Run the guild's queued jobs, store its newest messages and maintain its database when due."""
+    async with databases.acquire(guild_id) as database:
+        await ingestion.process_jobs(rest, database)
+        async with database.ingestion_lock:
+            await ingestion.follow(rest, database)
+        if time.time() - database.last_maintenance > MAINTENANCE_INTERVAL and await bot_idle(database):
+            await run_maintenance(database)
+
+
+async def run_worker() -> None:
+    rest_app = hikari.RESTApp()
+    await rest_app.start()
+    try:
+        async with rest_app.acquire(DISCORD_TOKEN, hikari.TokenType.BOT) as rest:
+            logging.info("Ingestion worker started.")
+            # Only one worker runs at a time, so any job still marked running was cut short by a restart
+            for guild_id in databases.databases:
+                async with databases.acquire(guild_id) as database:
+                    await ingestion.requeue_interrupted_jobs(database)
+            while True:
+                for guild_id in databases.databases:
+                    try:
+                        await ingest_guild(rest, guild_id)
+                    except Exception:
+                        # Keep serving the other guilds; the failed guild is retried on the next poll
+                        logging.exception("Ingestion failed for guild %s.", guild_id)
+                # Poll quickly while jobs are waiting on this process, otherwise at the configured interval
+                deadline = time.monotonic() + INGESTION_POLL_INTERVAL
+                while time.monotonic() < deadline and not await jobs_pending():
+                    await asyncio.sleep(1)
+    finally:
+        await databases.close_all()
+        await rest_app.close()
+
+
+async def jobs_pending() -> bool:
+    for database in databases.databases.values():
+        if not database.is_open:
+            continue
+        async with database.connection.execute(
+            "SELECT 1 FROM ingestion_jobs WHERE status = 'pending' LIMIT 1"
+        ) as cursor:
+            if await cursor.fetchone() is not None:
+                return True
+    return False
+
+
+def main():
+    logging.config.dictConfig(LOGGING_CONFIG)
+    log_listener = logging.getHandlerByName("queue").listener
+    log_listener.start()
+    try:
+        asyncio.run(run_worker())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_listener.stop()
+        print("Ingestion Worker Stopped Successfully!")
+
+
+if __name__ == "__main__":
+    main()